@@ -7,7 +7,7 @@ import os
 import ssl
 
 # Initialize the Quart app
-app = Quart(__name__)
+app = Quart(__name__, template_folder='TEMPLATES', static_folder='STATIC')
 
 # Enable CORS for all routes (allow cross-origin requests)
 app = cors(app, allow_origin="*")
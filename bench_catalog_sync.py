@@ -0,0 +1,176 @@
+"""
+Benchmark time-to-full-warm of a wiped replica.
+
+Runs the real origin and replica apps on hypercorn with TLS on localhost and
+refills an empty replica two ways: the bulk catalog sync (sync_from against
+the origin's /sync) and one multipart POST per video to the replica's
+/replicate (the origin's replicate_video_to_cache_servers). Also checks that
+an interrupted sync resumes without re-sending what already landed.
+
+Both servers and the client share one event loop, so the numbers include the
+TLS, HTTP/2 and file I/O cost on both ends but no network latency.
+
+    python bench_catalog_sync.py [--videos 50] [--size-mb 8] [--cert-dir cert]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import resource
+import shutil
+import socket
+import tempfile
+import time
+
+from hypercorn.asyncio import serve
+from hypercorn.config import Config
+
+from catalog_sync import build_inventory, is_catalog_file, sync_from
+from streaming import CHUNK_SIZE
+
+ORIGIN_DIRECTORY = 'origin_videos'
+REPLICA_DIRECTORY = 'replica_videos'
+
+# Quart rejects request bodies over 16 MB, which caps what /replicate accepts
+MAX_REPLICATE_MB = 15
+
+
+def make_catalog(directory, videos, size):
+    block = os.urandom(CHUNK_SIZE)
+    for i in range(videos):
+        with open(os.path.join(directory, f'video{i:05d}.mp4'), 'wb') as f:
+            for _ in range(size // CHUNK_SIZE):
+                f.write(block)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+async def start_server(app, port, shutdown):
+    """Serve an app the way its __main__ does (HTTP/2 over TLS) and wait until it accepts connections."""
+    config = Config()
+    config.bind = [f"localhost:{port}"]
+    config.certfile = 'cert/cert.pem'
+    config.keyfile = 'cert/key.pem'
+    config.alpn_protocols = ["h2", "http/1.1"]
+    config.loglevel = 'WARNING'
+    task = asyncio.create_task(serve(app, config, shutdown_trigger=shutdown.wait))
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('localhost', port)
+            writer.close()
+            return task
+        except OSError:
+            await asyncio.sleep(0.05)
+
+
+def reset(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+
+def catalog_sizes(directory):
+    return {entry.name: entry.stat().st_size for entry in os.scandir(directory) if is_catalog_file(entry.name)}
+
+
+def on_disk(directory):
+    return sum(entry.stat().st_size for entry in os.scandir(directory))
+
+
+async def main(args):
+    # Imported here, inside the workspace, since the replica creates its directories on import
+    import origin_server
+    import replica_server1
+
+    origin_port, replica_port = free_port(), free_port()
+    origin_url = f"https://localhost:{origin_port}"
+    origin_server.VIDEO_DIRECTORY = ORIGIN_DIRECTORY
+    origin_server.CACHE_SERVERS = [f"https://localhost:{replica_port}"]
+    replica_server1.REPLICA_VIDEO_DIRECTORY = REPLICA_DIRECTORY
+    ssl_context = replica_server1.get_client_ssl_context()
+
+    os.makedirs(ORIGIN_DIRECTORY)
+    size = args.size_mb * 1024 * 1024
+    make_catalog(ORIGIN_DIRECTORY, args.videos, size)
+    total = args.videos * size
+    expected = build_inventory(ORIGIN_DIRECTORY)['files']
+    print(f"Catalog: {args.videos} videos x {args.size_mb} MB = {total / 2**20:.0f} MB, HTTP/2 + TLS on localhost")
+
+    shutdown = asyncio.Event()
+    servers = [
+        await start_server(origin_server.app, origin_port, shutdown),
+        await start_server(replica_server1.app, replica_port, shutdown),
+    ]
+    # Keep the per-video log lines of both servers out of the benchmark report
+    log = io.StringIO()
+    try:
+        reset(REPLICA_DIRECTORY)
+        started = time.monotonic()
+        with contextlib.redirect_stdout(log):
+            for name in sorted(expected):
+                await origin_server.replicate_video_to_cache_servers(name)
+        per_file = time.monotonic() - started
+        # /replicate does not keep the origin's mtime, so only compare sizes here
+        warm = catalog_sizes(REPLICA_DIRECTORY) == catalog_sizes(ORIGIN_DIRECTORY)
+        print(f"Per-file /replicate: {per_file:7.2f}s to full warm ({total / per_file / 2**20:.0f} MB/s), "
+              f"fully warm: {warm}")
+
+        reset(REPLICA_DIRECTORY)
+        progress = {'files': 0, 'bytes': 0}
+        started = time.monotonic()
+        with contextlib.redirect_stdout(log):
+            await sync_from(origin_url, REPLICA_DIRECTORY, ssl_context, progress)
+        bulk = time.monotonic() - started
+        warm = build_inventory(REPLICA_DIRECTORY)['files'] == expected
+        print(f"Bulk /sync stream:   {bulk:7.2f}s to full warm ({total / bulk / 2**20:.0f} MB/s), "
+              f"fully warm: {warm}")
+
+        # Drop the connection part way through a video, then resume from the inventory
+        reset(REPLICA_DIRECTORY)
+        first = {'files': 0, 'bytes': 0}
+        with contextlib.redirect_stdout(log):
+            transfer = asyncio.create_task(sync_from(origin_url, REPLICA_DIRECTORY, ssl_context, first))
+            while first['bytes'] < total // 2 + size // 3 and not transfer.done():
+                await asyncio.sleep(0.01)
+            transfer.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await transfer
+            # Let a file write that was in flight when the transfer was cancelled finish
+            await asyncio.sleep(0.1)
+            landed = on_disk(REPLICA_DIRECTORY)
+            second = {'files': 0, 'bytes': 0}
+            await sync_from(origin_url, REPLICA_DIRECTORY, ssl_context, second)
+        resent = second['bytes'] - (total - landed)
+        warm = build_inventory(REPLICA_DIRECTORY)['files'] == expected
+        print(f"Resume: {first['files']} + {second['files']} videos, cut after {landed / 2**20:.1f} MB, "
+              f"{resent} bytes re-sent, fully warm: {warm}")
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"Peak RSS (client and both servers): {peak_rss:.0f} MB")
+    finally:
+        shutdown.set()
+        await asyncio.gather(*servers, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--videos', type=int, default=50, help='Number of videos in the catalog')
+    parser.add_argument('--size-mb', type=int, default=8, help=f'Size of each video in MB (at most {MAX_REPLICATE_MB})')
+    parser.add_argument('--cert-dir', default='cert', help='Directory with cert.pem and key.pem valid for localhost')
+    args = parser.parse_args()
+    if not 0 < args.size_mb <= MAX_REPLICATE_MB:
+        parser.error(f"--size-mb must be between 1 and {MAX_REPLICATE_MB}")
+
+    # The apps load cert/cert.pem and cert/key.pem relative to the working directory
+    cert_dir = os.path.abspath(args.cert_dir)
+    workspace = tempfile.mkdtemp(prefix='catalog-bench-')
+    try:
+        shutil.copytree(cert_dir, os.path.join(workspace, 'cert'))
+        os.chdir(workspace)
+        asyncio.run(main(args))
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
@@ -0,0 +1,256 @@
+import asyncio
+import os
+import struct
+import time
+
+import aiohttp
+
+from packager import VERSION_PATTERN
+from streaming import CHUNK_SIZE, read_file_chunks
+
+# Suffix of files still being received; they are never served to viewers
+PARTIAL_SUFFIX = '.part'
+
+# How many times a bootstrap retries a source after the stream breaks
+SYNC_ATTEMPTS = 5
+
+# Seconds to wait between retries (doubled after each failure)
+SYNC_RETRY_DELAY = 2
+
+# Only bound individual reads, a full catalog can take a long time to stream
+SYNC_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+# Archive stream layout (all integers big-endian):
+#   entry:  name length (H) | name (utf-8) | total size (Q) | mtime in ns (q) | start offset (Q) | file[offset:]
+#   end:    name length 0
+# A stream only ever carries whole remainders of files, so a receiver that got
+# cut off can report how far it got and ask for the rest.
+ENTRY_HEADER = struct.Struct('>QqQ')
+NAME_LENGTH = struct.Struct('>H')
+
+
+class SyncError(Exception):
+    """Raised when a catalog archive stream is malformed or truncated."""
+
+
+# ------------------------- Inventory -------------------------
+def is_catalog_file(name):
+    """Whether a directory entry is a video that belongs in the catalog."""
+    return name.lower().endswith('.mp4') and not name.startswith('.')
+
+
+def file_version(size, mtime_ns):
+    """
+    Identify one copy of a video by its size and modification time.
+
+    Same format as packager.source_version. Received videos get the source's
+    mtime, so a copy keeps its version from the origin through every replica
+    it is synced to.
+    """
+    return f'{size:x}-{max(mtime_ns, 0):x}'
+
+
+def partial_name(name, version):
+    """File name a video is received under until it is complete, e.g. `a.mp4.<version>.part`."""
+    return f'{name}.{version}{PARTIAL_SUFFIX}'
+
+
+def parse_partial_name(file_name):
+    """Split a partial file name into (video name, version), or return None."""
+    if not file_name.endswith(PARTIAL_SUFFIX):
+        return None
+    name, _, version = file_name[:-len(PARTIAL_SUFFIX)].rpartition('.')
+    if not is_catalog_file(name) or not VERSION_PATTERN.match(version):
+        return None
+    return name, version
+
+
+def build_inventory(directory):
+    """
+    List what a replica already holds.
+
+    `files` maps complete videos to their version (see file_version); `partial`
+    maps videos that were cut off mid-transfer to the version being received
+    and the number of bytes already on disk.
+    """
+    files, partial = {}, {}
+    for entry in os.scandir(directory):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        parsed = parse_partial_name(entry.name)
+        if parsed:
+            name, version = parsed
+            # Keep the furthest along if a video was cut off more than once
+            if stat.st_size >= partial.get(name, {}).get('offset', 0):
+                partial[name] = {'version': version, 'offset': stat.st_size}
+        elif is_catalog_file(entry.name):
+            files[entry.name] = file_version(stat.st_size, stat.st_mtime_ns)
+    return {'files': files, 'partial': partial}
+
+
+def validate_inventory(inventory):
+    """Check that an inventory from a requester has the shape build_inventory produces."""
+    if not isinstance(inventory, dict):
+        raise SyncError("Inventory must be a JSON object")
+    files = inventory.get('files', {})
+    partial = inventory.get('partial', {})
+    if not isinstance(files, dict) or not isinstance(partial, dict):
+        raise SyncError("Inventory 'files' and 'partial' must map video names to versions")
+    for name, version in files.items():
+        if not isinstance(version, str) or not VERSION_PATTERN.match(version):
+            raise SyncError(f"Invalid version {version!r} for {name!r} in inventory 'files'")
+    for name, entry in partial.items():
+        if not isinstance(entry, dict) or not isinstance(entry.get('version'), str) \
+                or not VERSION_PATTERN.match(entry['version']):
+            raise SyncError(f"Invalid entry {entry!r} for {name!r} in inventory 'partial'")
+        offset = entry.get('offset')
+        if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+            raise SyncError(f"Invalid offset {offset!r} for {name!r} in inventory 'partial'")
+
+
+def plan_transfer(directory, inventory):
+    """
+    Return (name, size, mtime_ns, offset) for every video the requester is missing.
+
+    A video is sent again when the requester's copy is a different version,
+    and a partial copy is only resumed if it is the same version as ours.
+    Raises SyncError if the inventory is malformed, so callers can reject the
+    request before any of the archive is sent.
+    """
+    validate_inventory(inventory)
+    have = inventory.get('files', {})
+    partial = inventory.get('partial', {})
+    plan = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not is_catalog_file(name) or not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        version = file_version(stat.st_size, stat.st_mtime_ns)
+        if have.get(name) == version:
+            continue
+        offset = 0
+        if name in partial and partial[name]['version'] == version and partial[name]['offset'] <= stat.st_size:
+            offset = partial[name]['offset']
+        plan.append((name, stat.st_size, stat.st_mtime_ns, offset))
+    return plan
+
+
+# ------------------------- Sending -------------------------
+async def iter_archive(directory, plan):
+    """Stream the videos in a transfer plan (see plan_transfer) as one archive, file after file."""
+    print(f"Sending {len(plan)} videos from {directory} for catalog sync")
+    for name, size, mtime_ns, offset in plan:
+        encoded = name.encode()
+        yield NAME_LENGTH.pack(len(encoded)) + encoded + ENTRY_HEADER.pack(size, mtime_ns, offset)
+        remaining = size - offset
+        async for chunk in read_file_chunks(os.path.join(directory, name), offset=offset):
+            chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+            if not remaining:
+                break
+        if remaining:
+            # The file shrank while streaming; the receiver can't recover the framing
+            raise SyncError(f"{name} changed while it was being sent")
+    yield NAME_LENGTH.pack(0)
+
+
+# ------------------------- Receiving -------------------------
+def remove_stale_partials(directory, name, keep):
+    """Remove partial copies of a video other than `keep` (left over from other versions)."""
+    for file_name in os.listdir(directory):
+        parsed = parse_partial_name(file_name)
+        # Partial files from before versioning were named `<video>.part`
+        stale = (parsed and parsed[0] == name) or file_name == name + PARTIAL_SUFFIX
+        if stale and file_name != keep:
+            os.remove(os.path.join(directory, file_name))
+
+
+async def receive_archive(reader, directory, progress):
+    """
+    Unpack an archive stream straight to disk.
+
+    Each video is written to a `.part` file named after its version in
+    CHUNK_SIZE pieces and renamed into place once complete, so it can be
+    served as soon as it lands while memory use stays bounded by a single
+    chunk. A resumed entry only ever appends to a partial copy of the same
+    version.
+    """
+    while True:
+        (name_length,) = NAME_LENGTH.unpack(await reader.readexactly(NAME_LENGTH.size))
+        if not name_length:
+            return
+        name = (await reader.readexactly(name_length)).decode()
+        size, mtime_ns, offset = ENTRY_HEADER.unpack(await reader.readexactly(ENTRY_HEADER.size))
+        if os.path.basename(name) != name or not is_catalog_file(name) or offset > size:
+            raise SyncError(f"Invalid archive entry {name!r}")
+
+        part = partial_name(name, file_version(size, mtime_ns))
+        partial_path = os.path.join(directory, part)
+        if offset and (not os.path.exists(partial_path) or os.path.getsize(partial_path) < offset):
+            raise SyncError(f"Cannot resume {name}, partial file is gone")
+        await asyncio.to_thread(remove_stale_partials, directory, name, part)
+        with open(partial_path, 'r+b' if offset else 'wb') as f:
+            f.seek(offset)
+            f.truncate()
+            remaining = size - offset
+            while remaining:
+                chunk = await reader.readexactly(min(CHUNK_SIZE, remaining))
+                await asyncio.to_thread(f.write, chunk)
+                remaining -= len(chunk)
+                progress['bytes'] += len(chunk)
+        # Carry the source's mtime over so this copy keeps the source's version
+        os.utime(partial_path, ns=(mtime_ns, mtime_ns))
+        os.replace(partial_path, os.path.join(directory, name))
+        progress['files'] += 1
+        print(f"Catalog sync: {name} is live ({size} bytes)")
+
+
+async def sync_from(source, directory, ssl_context, progress):
+    """Request everything missing from one source and unpack it as it arrives."""
+    inventory = await asyncio.to_thread(build_inventory, directory)
+    async with aiohttp.ClientSession(timeout=SYNC_TIMEOUT) as session:
+        async with session.post(f"{source}/sync", json=inventory, ssl=ssl_context) as response:
+            if response.status != 200:
+                raise SyncError(f"{source} returned status {response.status}")
+            await receive_archive(response.content, directory, progress)
+
+
+async def bootstrap_catalog(directory, sources, ssl_context, progress=None):
+    """
+    Bring a replica's catalog up to date from a list of sources.
+
+    Sources are tried in order and each only sends what is still missing, so
+    healthy siblings can do most of the work and the origin (listed last)
+    fills whatever gaps remain. A broken stream is resumed from the last
+    byte written, and a source that refuses the connection is skipped at
+    once. Returns the progress counters with the elapsed time.
+    """
+    progress = progress if progress is not None else {}
+    progress.update(files=0, bytes=0, running=True)
+    started = time.monotonic()
+    try:
+        for source in sources:
+            delay = SYNC_RETRY_DELAY
+            for attempt in range(1, SYNC_ATTEMPTS + 1):
+                try:
+                    await sync_from(source, directory, ssl_context, progress)
+                    break
+                except aiohttp.ClientConnectorError as e:
+                    # Nothing is listening there, move straight on to the next source
+                    print(f"Catalog sync from {source} skipped: {e}")
+                    break
+                except (aiohttp.ClientError, asyncio.IncompleteReadError, asyncio.TimeoutError, SyncError,
+                        UnicodeDecodeError, OSError) as e:
+                    print(f"Catalog sync from {source} failed (attempt {attempt}/{SYNC_ATTEMPTS}): {e!r}")
+                    if attempt < SYNC_ATTEMPTS:
+                        await asyncio.sleep(delay)
+                        delay *= 2
+    finally:
+        progress['running'] = False
+        progress['seconds'] = time.monotonic() - started
+    print(f"Catalog sync finished: {progress['files']} videos, {progress['bytes']} bytes "
+          f"in {progress['seconds']:.1f}s")
+    return progress
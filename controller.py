@@ -3,21 +3,74 @@ import aiohttp
 from quart_cors import cors
 import asyncio
 import ssl
+import zlib
+from collections import OrderedDict
+from packager import PACKAGED_FILE_PATTERN, PLAYLIST_NAME, VERSION_PATTERN, content_type_for
+from streaming import BandwidthScheduler, CHUNK_SIZE, iter_bytes, pace, parse_bitrate
 
 app = Quart(__name__)
 
 # Enable CORS for all origins
 app = cors(app, allow_origin="*")
 
+# Paced streams last as long as the video, so don't cap total response time
+app.config['RESPONSE_TIMEOUT'] = None
+
 # Define configuration variables for the replica servers
 REPLICA_SERVERS = ['https://localhost:8081', 'https://localhost:8082', 'https://localhost:8083']
 
+# Origin server, used for segments no replica can provide
+ORIGIN_SERVER = 'https://localhost:8080'
+
 # Path to the CA certificate
 CA_CERT_PATH = 'cert/cert.pem'
 
+# Memory budget for HLS segments cached by the controller
+SEGMENT_CACHE_BYTES = 256 * 1024 * 1024
+
+# Total uplink shared fairly across concurrent viewers (bits/s, None = unlimited)
+UPLINK_BITRATE = 500_000_000
+
+# Paced streams can run for the length of the video, so only bound each read
+STREAM_TIMEOUT = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+bandwidth = BandwidthScheduler(UPLINK_BITRATE)
+
 # Initialize round-robin index for each video (ensures even distribution of requests)
 round_robin_index = {}
 
+
+class SegmentCache:
+    """Least-recently-used in-memory cache of segments, bounded by total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, body, content_type):
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self.size -= len(self._entries.pop(key)[0])
+        self._entries[key] = (body, content_type)
+        self.size += len(body)
+        while self.size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+
+segment_cache = SegmentCache(SEGMENT_CACHE_BYTES)
+
+# Upstream segment fetches in flight, so concurrent misses only fetch once
+segment_fetches = {}
+
 def get_ssl_context():
     """Create and return a unified SSL context."""
     ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=CA_CERT_PATH)
@@ -42,6 +95,74 @@ def get_next_replica(video_name):
     return selected_replica
 
 
+def get_segment_servers(segment_path):
+    """
+    Order the servers to try for a segment.
+
+    Each segment is pinned to one replica by hashing its path, so it is only
+    cached once across the replica tier; the other replicas and finally the
+    origin are tried if that replica fails.
+    """
+    if not REPLICA_SERVERS:
+        return [ORIGIN_SERVER]
+    start = zlib.crc32(segment_path.encode()) % len(REPLICA_SERVERS)
+    return REPLICA_SERVERS[start:] + REPLICA_SERVERS[:start] + [ORIGIN_SERVER]
+
+
+async def fetch_segment(segment_path):
+    """Fetch a segment from its replica (or a fallback), returning its body and content type."""
+    ssl_context = get_ssl_context()
+    for server in get_segment_servers(segment_path):
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{server}/{segment_path}", ssl=ssl_context) as response:
+                    if response.status == 200:
+                        body = await response.read()
+                        return body, response.headers.get('Content-Type', content_type_for(segment_path))
+                    print(f"Server {server} returned status {response.status} for {segment_path}")
+        except Exception as e:
+            print(f"Error fetching segment {segment_path} from {server}: {e}")
+    return None
+
+
+async def fetch_playlist(video):
+    """
+    Fetch a playlist through the replicas (or the origin), returning (status, body, headers).
+
+    Playlists come from the origin whichever server relays them, so a 404 or a
+    503 (still packaging) is the final answer; only errors move on to the next
+    server.
+    """
+    playlist_path = f"hls/{video}/{PLAYLIST_NAME}"
+    ssl_context = get_ssl_context()
+    for server in get_segment_servers(playlist_path):
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{server}/{playlist_path}", ssl=ssl_context) as response:
+                    if response.status in (200, 404, 503):
+                        headers = {key: response.headers[key] for key in ('Content-Type', 'Retry-After')
+                                   if key in response.headers}
+                        return response.status, await response.read(), headers
+                    print(f"Server {server} returned status {response.status} for {playlist_path}")
+        except Exception as e:
+            print(f"Error fetching playlist {playlist_path} from {server}: {e}")
+    return None
+
+
+async def fetch_segment_once(segment_path):
+    """Fetch a segment and cache it, sharing one upstream request between concurrent misses."""
+    fetch = segment_fetches.get(segment_path)
+    if fetch is None:
+        fetch = asyncio.ensure_future(fetch_segment(segment_path))
+        segment_fetches[segment_path] = fetch
+        fetch.add_done_callback(lambda _: segment_fetches.pop(segment_path, None))
+    # A viewer disconnecting must not cancel the fetch other viewers wait on
+    cached = await asyncio.shield(fetch)
+    if cached is not None:
+        segment_cache.put(segment_path, *cached)
+    return cached
+
+
 async def check_video_on_replicas(video_name):
     """Asynchronously check if the video exists on any replica server."""
     ssl_context = get_ssl_context()
@@ -66,13 +187,17 @@ async def fetch_video_from_replica(replica_url, video_name):
 
         # Open the ClientSession outside the `generate` function
         session = aiohttp.ClientSession()
-        response = await session.get(video_url, ssl=ssl_context, timeout=aiohttp.ClientTimeout(total=300))
+        response = await session.get(video_url, ssl=ssl_context, timeout=STREAM_TIMEOUT)
 
         if response.status == 200:
             # Stream the response directly without closing the session prematurely
+            bitrate = parse_bitrate(response.headers)
+
             async def generate():
                 try:
-                    async for chunk in response.content.iter_chunked(1024 * 64):  # 64 KB chunks
+                    # 64 KB chunks, pulled from the replica only as fast as the client drains them
+                    chunks = response.content.iter_chunked(CHUNK_SIZE)
+                    async for chunk in pace(chunks, bandwidth, bitrate):
                         yield chunk
                 except Exception as e:
                     print(f"Error during video streaming from {replica_url}: {e}")
@@ -99,6 +224,37 @@ async def home():
     return "Welcome to the Video Controller!"
 
 
+@app.route('/hls/<video>/index.m3u8')
+async def get_playlist(video):
+    """Route to handle HLS playlist requests; playlists are never cached since they name the current version."""
+    playlist = await fetch_playlist(video)
+    if playlist is None:
+        return jsonify({'error': f'Playlist for {video} not available'}), 502
+    status, body, headers = playlist
+    content_type = headers.pop('Content-Type', content_type_for(PLAYLIST_NAME))
+    headers['Cache-Control'] = 'no-cache'
+    return Response(body, status=status, content_type=content_type, headers=headers)
+
+
+@app.route('/hls/<video>/<version>/<filename>')
+async def get_segment(video, version, filename):
+    """Route to handle HLS segment requests, cached per versioned segment."""
+    if not VERSION_PATTERN.match(version) or not PACKAGED_FILE_PATTERN.match(filename):
+        return jsonify({'error': f'Unknown segment {filename}'}), 404
+    segment_path = f"hls/{video}/{version}/{filename}"
+
+    cached = segment_cache.get(segment_path)
+    if cached is None:
+        cached = await fetch_segment_once(segment_path)
+        if cached is None:
+            return jsonify({'error': f'Segment {segment_path} not available'}), 502
+
+    body, content_type = cached
+    # Versioned segments never change
+    headers = {'Cache-Control': 'max-age=31536000, public, immutable'}
+    return Response(pace(iter_bytes(body), bandwidth), content_type=content_type, headers=headers)
+
+
 @app.route('/<video_name>.mp4')
 async def get_video(video_name):
     """Route to handle video streaming requests."""
@@ -123,13 +279,16 @@ async def get_video(video_name):
         print(f"Video not found on replicas, fetching from origin server at {origin_server_url}...")
         
         session = aiohttp.ClientSession()  # Create session outside the context manager
-        response = await session.get(origin_server_url, ssl=sslCtx)
+        response = await session.get(origin_server_url, ssl=sslCtx, timeout=STREAM_TIMEOUT)
 
         if response.status == 200:
+            bitrate = parse_bitrate(response.headers)
+
             async def generate():
                 try:
-                    # Stream chunks from the origin server
-                    async for chunk in response.content.iter_chunked(64 * 1024):  # 64 KB chunks
+                    # Stream chunks from the origin server as fast as the client drains them
+                    chunks = response.content.iter_chunked(CHUNK_SIZE)
+                    async for chunk in pace(chunks, bandwidth, bitrate):
                         yield chunk
                 except Exception as e:
                     print(f"Error during video streaming: {e}")
@@ -1,4 +1,4 @@
-from quart import Quart, Response, jsonify, send_from_directory
+from quart import Quart, Response, jsonify, request, send_from_directory
 import os
 import asyncio
 import aiohttp
@@ -6,6 +6,11 @@ from quart_cors import cors  # Use quart_cors for CORS support
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 import ssl
+from catalog_sync import SyncError, iter_archive, plan_transfer
+from packager import (
+    PACKAGED_DIRECTORY, PACKAGED_FILE_PATTERN, PLAYLIST_NAME, VERSION_PATTERN, PackagingError, content_type_for,
+    ensure_packaged, is_packaged, source_version
+)
 
 # Initialize Quart app
 app = Quart(__name__)
@@ -13,6 +18,9 @@ app = Quart(__name__)
 # Enable CORS for all routes (allow cross-origin requests)
 app = cors(app, allow_origin="*")
 
+# Catalog sync streams can run for a long time, so don't cap total response time
+app.config['RESPONSE_TIMEOUT'] = None
+
 # Directory where video files are located
 VIDEO_DIRECTORY = 'videos'
 
@@ -21,6 +29,19 @@ CACHE_SERVERS = [
     'https://localhost:8081', 'https://localhost:8082', 'https://localhost:8083'
 ]
 
+# Seconds a request waits for a video to be packaged before it is told to retry
+PACKAGING_WAIT = 5
+
+# Retry-After (seconds) sent while a video is still being packaged
+PACKAGING_RETRY_AFTER = 5
+
+# Packaging runs in the background, one task per video, so concurrent viewers
+# share it and a long remux never holds a request open
+packaging_tasks = {}
+
+# Version of each video whose packaging failed, so it is not retried until the source changes
+packaging_failures = {}
+
 # Path to the self-signed CA certificate
 CA_CERT_PATH = 'cert/cert.pem'
 
@@ -45,6 +66,16 @@ def get_video_path(video_name):
     """Constructs the absolute path to a video."""
     return os.path.abspath(os.path.join(VIDEO_DIRECTORY, video_name))
 
+def find_source_video(video):
+    """Finds the source file of a video by name, whatever the case of its .mp4 extension."""
+    source_path = get_video_path(f"{video}.mp4")
+    if os.path.exists(source_path):
+        return source_path
+    for file in sorted(os.listdir(VIDEO_DIRECTORY)):
+        if file.lower().endswith('.mp4') and file[:-len('.mp4')] == video:
+            return get_video_path(file)
+    return None
+
 def video_exists_locally(video_name):
     """Checks if a video exists in the local video directory."""
     return os.path.exists(get_video_path(video_name))
@@ -109,6 +140,101 @@ async def list_videos():
         print(f"Error reading video directory: {e}")
         return "Error reading video directory", 500
 
+@app.route('/sync', methods=['POST'])
+async def sync_catalog():
+    """Streams every video a replica is missing as one resumable archive."""
+    inventory = await request.get_json(silent=True)
+    try:
+        plan = await asyncio.to_thread(plan_transfer, VIDEO_DIRECTORY, inventory)
+    except SyncError as e:
+        return jsonify({'error': f'Invalid inventory in the request body: {e}'}), 400
+    return Response(iter_archive(VIDEO_DIRECTORY, plan), content_type='application/octet-stream')
+
+def finish_packaging(video, version, task):
+    """Forget a finished packaging task, remembering versions that cannot be segmented."""
+    packaging_tasks.pop(video, None)
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is None:
+        packaging_failures.pop(video, None)
+        return
+    print(f"Error packaging video {video}: {error}")
+    if isinstance(error, PackagingError):
+        packaging_failures[video] = version
+
+async def package_current_version(video):
+    """
+    Package the current version of a video on first use.
+
+    Packaging runs in the background. A request waits up to PACKAGING_WAIT
+    seconds for it and then gets a 503 with Retry-After, so long videos are
+    never remuxed inside a request that could time out.
+
+    Returns (packaged video directory, version), or (None, error response).
+    """
+    video = os.path.basename(video)
+    source_path = find_source_video(video)
+    if source_path is None:
+        return None, (jsonify({'error': f'Video {video} not found'}), 404)
+
+    video_dir = os.path.join(PACKAGED_DIRECTORY, video)
+    version = source_version(source_path)
+    if is_packaged(source_path, video_dir):
+        return video_dir, version
+    if packaging_failures.get(video) == version:
+        return None, (jsonify({'error': f'Video {video} cannot be segmented'}), 415)
+
+    task = packaging_tasks.get(video)
+    if task is None:
+        task = asyncio.ensure_future(asyncio.to_thread(ensure_packaged, source_path, video_dir))
+        packaging_tasks[video] = task
+        task.add_done_callback(lambda done: finish_packaging(video, version, done))
+    try:
+        # A request giving up must not cancel the packaging other requests wait on
+        version = await asyncio.wait_for(asyncio.shield(task), PACKAGING_WAIT)
+    except asyncio.TimeoutError:
+        error = jsonify({'error': f'Video {video} is still being packaged'})
+        return None, (error, 503, {'Retry-After': str(PACKAGING_RETRY_AFTER)})
+    except PackagingError:
+        return None, (jsonify({'error': f'Video {video} cannot be segmented'}), 415)
+    except Exception:
+        return None, (jsonify({'error': 'Internal Server Error'}), 500)
+    return video_dir, version
+
+@app.route('/hls/<video>/index.m3u8', methods=['GET'])
+async def serve_playlist(video):
+    """Serves the HLS playlist of a video, pointing at its current packaged version."""
+    video_dir, version = await package_current_version(video)
+    if video_dir is None:
+        return version
+    response = await send_from_directory(
+        os.path.join(video_dir, version), PLAYLIST_NAME, mimetype=content_type_for(PLAYLIST_NAME)
+    )
+    # The playlist changes when the source does, so caches must always revalidate it
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/hls/<video>/<version>/<filename>', methods=['GET'])
+async def serve_packaged_video(video, version, filename):
+    """Serves the init segment or a media segment of one packaged version of a video."""
+    if not VERSION_PATTERN.match(version) or not PACKAGED_FILE_PATTERN.match(filename):
+        return jsonify({'error': f'Unknown segment {filename}'}), 404
+
+    video_dir, current_version = await package_current_version(video)
+    if video_dir is None:
+        return current_version
+    if version != current_version:
+        return jsonify({'error': f'Version {version} of {video} is no longer available'}), 404
+
+    output_dir = os.path.join(video_dir, version)
+    if not os.path.exists(os.path.join(output_dir, filename)):
+        return jsonify({'error': f'Segment {filename} not found'}), 404
+    response = await send_from_directory(output_dir, filename, mimetype=content_type_for(filename))
+    # Versioned files never change
+    response.headers['Cache-Control'] = 'max-age=31536000, public, immutable'
+    return response
+
 @app.route('/<path:filename>', methods=['GET'])
 async def serve_video(filename):
     """Serves a video or redirects to a replica server if cached."""
@@ -0,0 +1,448 @@
+import os
+import re
+import shutil
+import struct
+import sys
+import tempfile
+
+# Directory where packaged (segmented) videos are written by the origin
+PACKAGED_DIRECTORY = '.packaged_videos'
+
+# Target segment length in seconds (segments are cut on video keyframes)
+SEGMENT_DURATION = 4
+
+PLAYLIST_NAME = 'index.m3u8'
+INIT_SEGMENT_NAME = 'init.mp4'
+SEGMENT_NAME_FORMAT = 'seg_{:05d}.m4s'
+
+# Names of the immutable files inside a packaged version (used to validate requests)
+PACKAGED_FILE_PATTERN = re.compile(r'^(init\.mp4|seg_\d{5}\.m4s)$')
+
+# Packaged versions are named after the source's size and mtime (see source_version)
+VERSION_PATTERN = re.compile(r'^[0-9a-f]+-[0-9a-f]+$')
+
+# Container boxes we descend into when parsing and rebuilding the moov
+CONTAINER_BOXES = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+
+# trun sample flags for sync and non-sync samples
+SYNC_SAMPLE_FLAGS = 0x02000000
+NON_SYNC_SAMPLE_FLAGS = 0x01010000
+
+
+class PackagingError(Exception):
+    """Raised when an MP4 file cannot be remuxed into segments."""
+
+
+# ------------------------- Box Helpers -------------------------
+def box(box_type, *payloads):
+    """Serialize an MP4 box."""
+    payload = b''.join(payloads)
+    return struct.pack('>I4s', 8 + len(payload), box_type) + payload
+
+
+def full_box(box_type, version, flags, *payloads):
+    """Serialize an MP4 full box (box with version and flags)."""
+    return box(box_type, struct.pack('>I', (version << 24) | flags), *payloads)
+
+
+def iter_boxes(data, start=0, end=None):
+    """Yield (type, header start, payload start, box end) for boxes in data[start:end]."""
+    end = len(data) if end is None else end
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', data, offset)
+        header = 8
+        if size == 1:
+            size = struct.unpack_from('>Q', data, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header or offset + size > end:
+            raise PackagingError(f"Malformed {box_type!r} box at offset {offset}")
+        yield box_type, offset, offset + header, offset + size
+        offset += size
+
+
+def find_box(data, path, start=0, end=None):
+    """Return (payload start, box end) of the first box matching a type path, or None."""
+    for box_type, _, payload, box_end in iter_boxes(data, start, end):
+        if box_type == path[0]:
+            if len(path) == 1:
+                return payload, box_end
+            return find_box(data, path[1:], payload, box_end)
+    return None
+
+
+def read_top_level_box(f, wanted):
+    """Read a whole top-level box (e.g. moov) from an open file."""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header:
+            break
+        if box_type == wanted:
+            f.seek(offset)
+            return f.read(size)
+        offset += size
+    raise PackagingError(f"No {wanted!r} box found")
+
+
+# ------------------------- Sample Tables -------------------------
+class Track:
+    """A single audio or video track and its flattened sample table."""
+
+    def __init__(self, track_id, handler, timescale, trak):
+        self.track_id = track_id
+        self.handler = handler
+        self.timescale = timescale
+        self.trak = trak            # Raw trak box, used to build the init segment
+        self.offsets = []
+        self.sizes = []
+        self.decode_times = []
+        self.durations = []
+        self.cts_offsets = []
+        self.sync = []
+
+    @property
+    def end_time(self):
+        if not self.decode_times:
+            return 0
+        return (self.decode_times[-1] + self.durations[-1]) / self.timescale
+
+
+def _full_box_entries(data, payload, fmt):
+    """Unpack the entry list of a table-style full box (version/flags, count, entries)."""
+    count = struct.unpack_from('>I', data, payload + 4)[0]
+    entry_size = struct.calcsize(fmt)
+    start = payload + 8
+    return [struct.unpack_from(fmt, data, start + i * entry_size) for i in range(count)]
+
+
+def parse_track(moov, trak_start, trak_end):
+    """Parse one trak box into a Track, or return None for unsupported tracks."""
+    trak = moov[trak_start:trak_end]
+    hdlr = find_box(trak, [b'trak', b'mdia', b'hdlr'])
+    mdhd = find_box(trak, [b'trak', b'mdia', b'mdhd'])
+    tkhd = find_box(trak, [b'trak', b'tkhd'])
+    stbl = find_box(trak, [b'trak', b'mdia', b'minf', b'stbl'])
+    if not (hdlr and mdhd and tkhd and stbl):
+        return None
+
+    handler = trak[hdlr[0] + 8:hdlr[0] + 12]
+    if handler not in (b'vide', b'soun'):
+        return None
+
+    track_id = struct.unpack_from('>I', trak, tkhd[0] + (20 if trak[tkhd[0]] == 1 else 12))[0]
+    timescale = struct.unpack_from('>I', trak, mdhd[0] + (20 if trak[mdhd[0]] == 1 else 12))[0]
+    track = Track(track_id, handler, timescale, trak)
+
+    tables = {box_type: payload for box_type, _, payload, _ in iter_boxes(trak, *stbl)}
+    if b'stsz' not in tables or b'stts' not in tables or b'stsc' not in tables:
+        raise PackagingError(f"Track {track_id} has no usable sample table")
+
+    # Sample sizes
+    uniform_size, sample_count = struct.unpack_from('>II', trak, tables[b'stsz'] + 4)
+    if uniform_size:
+        track.sizes = [uniform_size] * sample_count
+    else:
+        track.sizes = list(struct.unpack_from(f'>{sample_count}I', trak, tables[b'stsz'] + 12))
+
+    # Decode times
+    time = 0
+    for count, delta in _full_box_entries(trak, tables[b'stts'], '>II'):
+        for _ in range(count):
+            track.decode_times.append(time)
+            track.durations.append(delta)
+            time += delta
+
+    # Composition offsets (version 1 entries are signed)
+    if b'ctts' in tables:
+        fmt = '>Ii' if trak[tables[b'ctts']] == 1 else '>II'
+        for count, offset in _full_box_entries(trak, tables[b'ctts'], fmt):
+            track.cts_offsets.extend([offset] * count)
+    track.cts_offsets.extend([0] * (sample_count - len(track.cts_offsets)))
+
+    # Sync samples (no stss box means every sample is a sync sample)
+    if b'stss' in tables:
+        sync_numbers = {n for (n,) in _full_box_entries(trak, tables[b'stss'], '>I')}
+        track.sync = [i + 1 in sync_numbers for i in range(sample_count)]
+    else:
+        track.sync = [True] * sample_count
+
+    # Sample file offsets from chunk offsets and the sample-to-chunk map
+    if b'stco' in tables:
+        chunk_offsets = [o for (o,) in _full_box_entries(trak, tables[b'stco'], '>I')]
+    elif b'co64' in tables:
+        chunk_offsets = [o for (o,) in _full_box_entries(trak, tables[b'co64'], '>Q')]
+    else:
+        raise PackagingError(f"Track {track_id} has no chunk offsets")
+    stsc = _full_box_entries(trak, tables[b'stsc'], '>III')
+    sample = 0
+    for i, (first_chunk, samples_per_chunk, _) in enumerate(stsc):
+        last_chunk = stsc[i + 1][0] - 1 if i + 1 < len(stsc) else len(chunk_offsets)
+        for chunk in range(first_chunk - 1, last_chunk):
+            offset = chunk_offsets[chunk]
+            for _ in range(samples_per_chunk):
+                if sample >= sample_count:
+                    break
+                track.offsets.append(offset)
+                offset += track.sizes[sample]
+                sample += 1
+
+    if not (len(track.offsets) == len(track.decode_times) == sample_count):
+        raise PackagingError(f"Track {track_id} has an inconsistent sample table")
+    return track
+
+
+def parse_movie(f):
+    """Parse the moov box of an open MP4 file into (movie timescale, tracks)."""
+    moov = read_top_level_box(f, b'moov')
+    mvhd = find_box(moov, [b'moov', b'mvhd'])
+    if not mvhd:
+        raise PackagingError("No mvhd box found")
+    timescale = struct.unpack_from('>I', moov, mvhd[0] + (20 if moov[mvhd[0]] == 1 else 12))[0]
+
+    tracks = []
+    moov_payload = find_box(moov, [b'moov'])
+    for box_type, start, _, end in iter_boxes(moov, *moov_payload):
+        if box_type == b'trak':
+            track = parse_track(moov, start, end)
+            if track and track.sizes:
+                tracks.append(track)
+    if not tracks:
+        raise PackagingError("No audio or video tracks found")
+    return timescale, tracks
+
+
+# ------------------------- Segment Writers -------------------------
+def _rebuild_box(data, start, end):
+    """Copy a box, descending into containers and emptying the sample table."""
+    box_type, _, payload, box_end = next(iter_boxes(data, start, end))
+    if box_type == b'stbl':
+        children = [data[s:e] for t, s, _, e in iter_boxes(data, payload, box_end) if t == b'stsd']
+        empty_tables = [
+            full_box(b'stts', 0, 0, struct.pack('>I', 0)),
+            full_box(b'stsc', 0, 0, struct.pack('>I', 0)),
+            full_box(b'stsz', 0, 0, struct.pack('>II', 0, 0)),
+            full_box(b'stco', 0, 0, struct.pack('>I', 0)),
+        ]
+        return box(b'stbl', *children, *empty_tables)
+    if box_type in CONTAINER_BOXES:
+        return box(box_type, *(_rebuild_box(data, s, e) for _, s, _, e in iter_boxes(data, payload, box_end)))
+    return data[start:box_end]
+
+
+def build_init_segment(movie_timescale, tracks):
+    """Build the fMP4 initialization segment (ftyp + moov with mvex)."""
+    ftyp = box(b'ftyp', b'iso6', struct.pack('>I', 0), b'iso6', b'iso5', b'mp41', b'dash')
+    mvhd = full_box(
+        b'mvhd', 0, 0,
+        struct.pack('>IIII', 0, 0, movie_timescale, 0),
+        struct.pack('>IH', 0x00010000, 0x0100), bytes(10),
+        struct.pack('>9I', 0x00010000, 0, 0, 0, 0x00010000, 0, 0, 0, 0x40000000),
+        bytes(24),
+        struct.pack('>I', max(t.track_id for t in tracks) + 1),
+    )
+    traks = [_rebuild_box(t.trak, 0, len(t.trak)) for t in tracks]
+    trexs = [full_box(b'trex', 0, 0, struct.pack('>IIIII', t.track_id, 1, 0, 0, 0)) for t in tracks]
+    return ftyp + box(b'moov', mvhd, *traks, box(b'mvex', *trexs))
+
+
+def _build_moof(sequence_number, fragments, data_offsets):
+    """Build a moof box; `fragments` is a list of (track, first sample, end sample)."""
+    trafs = []
+    for (track, first, end), data_offset in zip(fragments, data_offsets):
+        samples = b''.join(
+            struct.pack(
+                '>IIIi',
+                track.durations[i],
+                track.sizes[i],
+                SYNC_SAMPLE_FLAGS if track.sync[i] else NON_SYNC_SAMPLE_FLAGS,
+                track.cts_offsets[i],
+            )
+            for i in range(first, end)
+        )
+        trafs.append(box(
+            b'traf',
+            full_box(b'tfhd', 0, 0x020000, struct.pack('>I', track.track_id)),
+            full_box(b'tfdt', 1, 0, struct.pack('>Q', track.decode_times[first])),
+            # data-offset, duration, size, flags and composition offset per sample
+            full_box(b'trun', 1, 0x000F01, struct.pack('>Ii', end - first, data_offset), samples),
+        ))
+    return box(b'moof', full_box(b'mfhd', 0, 0, struct.pack('>I', sequence_number)), *trafs)
+
+
+def write_media_segment(f, out, sequence_number, fragments):
+    """Write one moof + mdat media segment covering the given sample ranges."""
+    sizes = [sum(track.sizes[first:end]) for track, first, end in fragments]
+    moof_size = len(_build_moof(sequence_number, fragments, [0] * len(fragments)))
+
+    data_offsets = []
+    offset = moof_size + 8
+    for size in sizes:
+        data_offsets.append(offset)
+        offset += size
+    out.write(_build_moof(sequence_number, fragments, data_offsets))
+    out.write(struct.pack('>I4s', 8 + sum(sizes), b'mdat'))
+
+    for track, first, end in fragments:
+        for i in range(first, end):
+            f.seek(track.offsets[i])
+            out.write(f.read(track.sizes[i]))
+
+
+def segment_boundaries(tracks, segment_duration):
+    """Pick segment start times (seconds), cutting on video keyframes when possible."""
+    reference = next((t for t in tracks if t.handler == b'vide'), tracks[0])
+    boundaries = [0.0]
+    for i, is_sync in enumerate(reference.sync):
+        start = reference.decode_times[i] / reference.timescale
+        if is_sync and start - boundaries[-1] >= segment_duration:
+            boundaries.append(start)
+    return boundaries
+
+
+def _first_sample_at(track, seconds):
+    """Index of the first sample in a track decoded at or after `seconds`."""
+    limit = seconds * track.timescale
+    for i, decode_time in enumerate(track.decode_times):
+        if decode_time >= limit:
+            return i
+    return len(track.decode_times)
+
+
+def build_playlist(durations, uri_prefix=''):
+    """Build an HLS VOD media playlist for fMP4 segments."""
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:7',
+        f'#EXT-X-TARGETDURATION:{max(int(d + 0.999) for d in durations)}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+        '#EXT-X-INDEPENDENT-SEGMENTS',
+        f'#EXT-X-MAP:URI="{uri_prefix}{INIT_SEGMENT_NAME}"',
+    ]
+    for i, duration in enumerate(durations):
+        lines.append(f'#EXTINF:{duration:.3f},')
+        lines.append(uri_prefix + SEGMENT_NAME_FORMAT.format(i))
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+# ------------------------- Packaging Entry Points -------------------------
+def package_video(source_path, output_dir, segment_duration=SEGMENT_DURATION, uri_prefix=''):
+    """
+    Remux an MP4 file into fMP4 segments with an HLS playlist.
+
+    The output is written to a temporary directory and moved into place once
+    complete, so readers never see a partially packaged video. `uri_prefix` is
+    prepended to the segment URIs in the playlist.
+    """
+    parent = os.path.dirname(os.path.abspath(output_dir))
+    os.makedirs(parent, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(dir=parent, prefix='.packaging-')
+    try:
+        with open(source_path, 'rb') as f:
+            movie_timescale, tracks = parse_movie(f)
+
+            with open(os.path.join(staging_dir, INIT_SEGMENT_NAME), 'wb') as out:
+                out.write(build_init_segment(movie_timescale, tracks))
+
+            boundaries = segment_boundaries(tracks, segment_duration)
+            end_time = max(t.end_time for t in tracks)
+            starts = [[_first_sample_at(t, b) for b in boundaries] for t in tracks]
+            durations = []
+            for n in range(len(boundaries)):
+                fragments = []
+                for track, track_starts in zip(tracks, starts):
+                    first = track_starts[n]
+                    end = track_starts[n + 1] if n + 1 < len(boundaries) else len(track.sizes)
+                    if end > first:
+                        fragments.append((track, first, end))
+                if not fragments:
+                    continue
+                segment_path = os.path.join(staging_dir, SEGMENT_NAME_FORMAT.format(len(durations)))
+                with open(segment_path, 'wb') as out:
+                    write_media_segment(f, out, len(durations) + 1, fragments)
+                next_boundary = boundaries[n + 1] if n + 1 < len(boundaries) else end_time
+                durations.append(next_boundary - boundaries[n])
+
+        with open(os.path.join(staging_dir, PLAYLIST_NAME), 'w') as out:
+            out.write(build_playlist(durations, uri_prefix))
+
+        if os.path.isdir(output_dir):
+            shutil.rmtree(output_dir)
+        os.replace(staging_dir, output_dir)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    return len(durations)
+
+
+def source_version(source_path):
+    """
+    Identify the current contents of a source video.
+
+    Segments are served under this version, so a replaced source gets new
+    segment URLs and no cache can mix old and new files.
+    """
+    stat = os.stat(source_path)
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+
+def is_packaged(source_path, video_dir):
+    """Check whether the current version of a video has been packaged."""
+    playlist = os.path.join(video_dir, source_version(source_path), PLAYLIST_NAME)
+    return os.path.exists(playlist)
+
+
+def prune_versions(video_dir, keep):
+    """Remove every packaged or cached version of a video except `keep`."""
+    if not os.path.isdir(video_dir):
+        return
+    for name in os.listdir(video_dir):
+        if name != keep and VERSION_PATTERN.match(name):
+            shutil.rmtree(os.path.join(video_dir, name), ignore_errors=True)
+
+
+def ensure_packaged(source_path, video_dir, segment_duration=SEGMENT_DURATION):
+    """
+    Package the current version of a video unless it already is.
+
+    Output goes to `video_dir/<version>/`, with playlist URIs relative to
+    `video_dir`. Returns the version.
+    """
+    version = source_version(source_path)
+    if not is_packaged(source_path, video_dir):
+        output_dir = os.path.join(video_dir, version)
+        segment_count = package_video(source_path, output_dir, segment_duration, uri_prefix=f'{version}/')
+        print(f"Packaged {source_path} into {segment_count} segments at {output_dir}")
+        prune_versions(video_dir, version)
+    return version
+
+
+def content_type_for(filename):
+    """Return the content type for a file inside a packaged video directory."""
+    if filename.endswith('.m3u8'):
+        return 'application/vnd.apple.mpegurl'
+    if filename.endswith('.m4s'):
+        return 'video/iso.segment'
+    return 'video/mp4'
+
+
+if __name__ == '__main__':
+    # Package every MP4 in a directory ahead of time: python packager.py [videos]
+    video_directory = sys.argv[1] if len(sys.argv) > 1 else 'videos'
+    for name in sorted(os.listdir(video_directory)):
+        if name.lower().endswith('.mp4'):
+            stem = os.path.splitext(name)[0]
+            ensure_packaged(os.path.join(video_directory, name), os.path.join(PACKAGED_DIRECTORY, stem))
@@ -1,10 +1,14 @@
-from quart import Quart, Response, request
+from quart import Quart, Response, jsonify, request
 import os
 import ssl
+import aiohttp
 from quart_cors import cors  # Use quart_cors for CORS support
 from hypercorn.asyncio import serve
 from hypercorn.config import Config
 import asyncio
+from catalog_sync import PARTIAL_SUFFIX, SyncError, bootstrap_catalog, build_inventory, iter_archive, plan_transfer
+from packager import PACKAGED_FILE_PATTERN, PLAYLIST_NAME, VERSION_PATTERN, content_type_for, prune_versions
+from streaming import BandwidthScheduler, BITRATE_HEADER, CHUNK_SIZE, pace, probe_bitrate, read_file_chunks
 
 # Initialize Quart app
 app = Quart(__name__)
@@ -12,14 +16,46 @@ app = Quart(__name__)
 # Enable CORS for all routes (allow cross-origin requests)
 app = cors(app, allow_origin="*")
 
+# Paced streams last as long as the video, so don't cap total response time
+app.config['RESPONSE_TIMEOUT'] = None
+
 # Directory to store replicated videos
 REPLICA_VIDEO_DIRECTORY = '.replicated_videos_1'
 
+# Directory to cache individual HLS segments pulled from the origin
+REPLICA_SEGMENT_DIRECTORY = '.replicated_segments_1'
+
+# Origin server that packages videos into segments
+ORIGIN_SERVER = 'https://localhost:8080'
+
+# Other replicas that can refill this one after a wipe (origin is used last)
+SIBLING_SERVERS = ['https://localhost:8082', 'https://localhost:8083']
+
+# Pull the whole catalog in bulk when the server starts with no videos (fresh or wiped).
+# Off by default; a running replica can always be refilled with POST /bootstrap.
+BOOTSTRAP_ON_STARTUP = False
+
 # Path to the CA certificate
 # Ensure the replica video directory exists
 os.makedirs(REPLICA_VIDEO_DIRECTORY, exist_ok=True)
+os.makedirs(REPLICA_SEGMENT_DIRECTORY, exist_ok=True)
 CA_CERT_PATH = 'cert/cert.pem'
 
+# Total uplink shared fairly across concurrent viewers (bits/s, None = unlimited)
+UPLINK_BITRATE = 200_000_000
+
+# Pace each stream at its video bitrate after the startup burst
+PACE_STREAMS = True
+
+bandwidth = BandwidthScheduler(UPLINK_BITRATE)
+
+# Origin fetches in flight, keyed by segment path, so concurrent misses only pull it once
+segment_fetches = {}
+
+# Progress of the running (or last) catalog bootstrap
+bootstrap_progress = {}
+bootstrap_task = None
+
 
 def get_ssl_context():
     """Create and return a unified SSL context."""
@@ -28,6 +64,12 @@ def get_ssl_context():
     ssl_context.load_verify_locations(cafile=CA_CERT_PATH)
     ssl_context.verify_mode = ssl.CERT_OPTIONAL
     return ssl_context
+
+def get_client_ssl_context():
+    """Create and return an SSL context for requests to the origin server."""
+    ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=CA_CERT_PATH)
+    ssl_context.load_cert_chain(certfile='cert/cert.pem', keyfile='cert/key.pem')
+    return ssl_context
 @app.route('/')
 async def home():
     """
@@ -47,7 +89,8 @@ async def serve_replicated_video(video_name):
     video_name = os.path.basename(video_name)
     video_path = os.path.join(REPLICA_VIDEO_DIRECTORY, video_name)
 
-    if os.path.exists(video_path):
+    # Videos still arriving through a catalog sync are not served yet
+    if os.path.exists(video_path) and not video_name.endswith(PARTIAL_SUFFIX):
         if request.method == 'HEAD':
             # For HEAD requests, only check the existence of the file
             return Response(status=200)
@@ -57,6 +100,95 @@ async def serve_replicated_video(video_name):
 
     return Response('Video not found', status=404)
 
+@app.route('/hls/<video>/index.m3u8')
+async def serve_playlist(video):
+    """
+    Relay the HLS playlist of a video from the origin.
+
+    The playlist is not cached: it names the current packaged version, which
+    changes whenever the source video does.
+    """
+    video = os.path.basename(video)
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{ORIGIN_SERVER}/hls/{video}/{PLAYLIST_NAME}", ssl=get_client_ssl_context()) as response:
+                body = await response.read()
+                if response.status != 200:
+                    print(f"Origin returned status {response.status} for playlist of {video}")
+                    # Pass on why, e.g. a 503 with Retry-After while the origin is still packaging
+                    headers = {'Retry-After': response.headers['Retry-After']} if 'Retry-After' in response.headers else {}
+                    return Response(body, status=response.status, content_type=response.content_type, headers=headers)
+    except Exception as e:
+        print(f"Error fetching playlist of {video} from origin: {e}")
+        return Response('Origin unavailable', status=502)
+    return Response(body, content_type=content_type_for(PLAYLIST_NAME), headers={'Cache-Control': 'no-cache'})
+
+@app.route('/hls/<video>/<version>/<filename>')
+async def serve_segment(video, version, filename):
+    """
+    Serve a single segment of one packaged version, pulling it from the origin on a miss.
+
+    - HEAD: Check if the segment is cached and return 200 if it is.
+    - GET: Stream the segment, fetching and caching it first if needed.
+    """
+    # Sanitize the names to prevent directory traversal
+    video = os.path.basename(video)
+    if not VERSION_PATTERN.match(version) or not PACKAGED_FILE_PATTERN.match(filename):
+        return Response('Segment not found', status=404)
+    segment_path = os.path.join(REPLICA_SEGMENT_DIRECTORY, video, version, filename)
+
+    if not os.path.exists(segment_path):
+        if request.method == 'HEAD':
+            return Response(status=404)
+        await fetch_segment_once(f"{video}/{version}/{filename}", segment_path)
+        if not os.path.exists(segment_path):
+            return Response('Segment not found', status=404)
+
+    if request.method == 'HEAD':
+        return Response(status=200)
+    # Versioned segments never change
+    headers = {'Cache-Control': 'max-age=31536000, public, immutable'}
+    return Response(pace(read_file_chunks(segment_path), bandwidth), content_type=content_type_for(filename), headers=headers)
+
+async def fetch_segment_once(segment_name, segment_path):
+    """Fetch a segment from the origin, sharing one download between concurrent misses."""
+    fetch = segment_fetches.get(segment_path)
+    if fetch is None:
+        fetch = asyncio.ensure_future(fetch_segment_from_origin(segment_name, segment_path))
+        segment_fetches[segment_path] = fetch
+        # Forget the fetch once it is done so the map only holds segments in flight
+        fetch.add_done_callback(lambda _: segment_fetches.pop(segment_path, None))
+    # A viewer disconnecting must not cancel the download other viewers wait on
+    await asyncio.shield(fetch)
+
+async def fetch_segment_from_origin(segment_name, segment_path):
+    """Download one segment (`video/version/file`) from the origin server into the segment cache."""
+    segment_url = f"{ORIGIN_SERVER}/hls/{segment_name}"
+    temp_path = f"{segment_path}.part"
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(segment_url, ssl=get_client_ssl_context()) as response:
+                if response.status != 200:
+                    print(f"Origin returned status {response.status} for segment {segment_name}")
+                    return
+                version_dir = os.path.dirname(segment_path)
+                new_version = not os.path.isdir(version_dir)
+                os.makedirs(version_dir, exist_ok=True)
+                with open(temp_path, 'wb') as segment_file:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await asyncio.to_thread(segment_file.write, chunk)
+        # Publish the segment only once it is complete
+        os.replace(temp_path, segment_path)
+        print(f"Segment {segment_name} cached from origin.")
+
+        if new_version:
+            # A newer version replaces whatever was cached for this video before
+            await asyncio.to_thread(prune_versions, os.path.dirname(version_dir), os.path.basename(version_dir))
+    except Exception as e:
+        print(f"Error fetching segment {segment_name} from origin: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
 @app.route('/replicate', methods=['POST'])
 async def replicate_video():
     """
@@ -95,18 +227,67 @@ async def replicate_video():
         print(f"Error during replication: {e}")
         return Response(f"Error during replication: {str(e)}", status=500)
 
+@app.route('/sync', methods=['POST'])
+async def sync_catalog():
+    """
+    Stream every video the requesting replica is missing as a single archive.
+
+    The request body is the requester's inventory (see catalog_sync.build_inventory).
+    """
+    inventory = await request.get_json(silent=True)
+    try:
+        plan = await asyncio.to_thread(plan_transfer, REPLICA_VIDEO_DIRECTORY, inventory)
+    except SyncError as e:
+        return Response(f"Invalid inventory in the request body: {e}", status=400)
+    archive = iter_archive(REPLICA_VIDEO_DIRECTORY, plan)
+    return Response(pace(archive, bandwidth), content_type="application/octet-stream")
+
+@app.route('/bootstrap', methods=['GET', 'POST'])
+async def bootstrap():
+    """
+    Refill this replica from its siblings and the origin.
+
+    - GET: Report the progress of the current or last bootstrap.
+    - POST: Start a bootstrap in the background unless one is already running.
+    """
+    if request.method == 'POST' and not bootstrap_progress.get('running'):
+        start_bootstrap()
+        return jsonify(bootstrap_progress), 202
+    return jsonify(bootstrap_progress), 200
+
+def start_bootstrap():
+    """Start pulling every missing video in bulk, going live as each one lands."""
+    global bootstrap_task
+    sources = SIBLING_SERVERS + [ORIGIN_SERVER]
+    bootstrap_progress['running'] = True
+    bootstrap_task = asyncio.create_task(
+        bootstrap_catalog(REPLICA_VIDEO_DIRECTORY, sources, get_client_ssl_context(), bootstrap_progress)
+    )
+
+@app.before_serving
+async def bootstrap_on_startup():
+    """Bring a fresh or wiped replica back to a warm catalog, if enabled."""
+    if not BOOTSTRAP_ON_STARTUP:
+        return
+    inventory = await asyncio.to_thread(build_inventory, REPLICA_VIDEO_DIRECTORY)
+    if not inventory['files']:
+        start_bootstrap()
+
 async def stream_video(video_path):
-    """Asynchronously stream a video file."""
-    def generate():
+    """Asynchronously stream a video file, paced and sharing the uplink fairly."""
+    bitrate = await asyncio.to_thread(probe_bitrate, video_path) if PACE_STREAMS else None
+
+    async def generate():
         try:
-            with open(video_path, 'rb') as video_file:
-                while chunk := video_file.read(1024 * 64):  # Stream 64 KB chunks
-                    yield chunk
+            # 64 KB chunks, only read from disk as fast as the client drains them
+            async for chunk in pace(read_file_chunks(video_path), bandwidth, bitrate):
+                yield chunk
         except Exception as e:
             print(f"Error during video streaming: {e}")
             raise e
 
-    return Response(generate(), content_type="video/mp4")
+    headers = {BITRATE_HEADER: str(bitrate)} if bitrate else {}
+    return Response(generate(), content_type="video/mp4", headers=headers)
 
 if __name__ == '__main__':
     # Configure the server to use HTTP/2 with SSL and require client certificates
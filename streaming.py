@@ -0,0 +1,273 @@
+import asyncio
+import os
+import struct
+import time
+
+# Size of each chunk pushed to a client
+CHUNK_SIZE = 64 * 1024
+
+# Seconds of video a new stream may send at full speed before pacing kicks in
+STARTUP_BURST_SECONDS = 10
+
+# Sustained pacing rate as a multiple of the video bitrate (headroom for jitter)
+PACING_HEADROOM = 1.5
+
+# Response header carrying the video bitrate (bits per second) between servers
+BITRATE_HEADER = 'X-Content-Bitrate'
+
+# Seconds between re-measuring how fast each stream actually drains
+REBALANCE_INTERVAL = 1.0
+
+# A stream using less than this fraction of its share is limited by its client
+CLIENT_LIMITED_RATIO = 0.9
+
+# Client-limited streams may grow this much per interval before re-measuring
+DEMAND_HEADROOM = 1.5
+
+# Smallest share (bytes/s) a slow or stalled stream is left with
+MIN_STREAM_RATE = CHUNK_SIZE
+
+
+# ------------------------- Fair Bandwidth Sharing -------------------------
+def max_min_shares(capacity, demands):
+    """
+    Split `capacity` across streams using max-min fairness.
+
+    `demands` maps a stream to its maximum useful rate (None = unbounded).
+    Streams asking for less than an equal share keep their demand, and the
+    leftover is spread evenly over the remaining streams. Capacity still left
+    once every demand is met is spread evenly too, so nothing sits idle.
+    """
+    shares = {}
+    pending = dict(demands)
+    remaining = capacity
+    while True:
+        if not pending:
+            for stream in shares:
+                shares[stream] += remaining / len(shares)
+            break
+        equal_share = remaining / len(pending)
+        satisfied = {s: d for s, d in pending.items() if d is not None and d <= equal_share}
+        if not satisfied:
+            for stream in pending:
+                shares[stream] = equal_share
+            break
+        for stream, demand in satisfied.items():
+            shares[stream] = demand
+            remaining -= demand
+            del pending[stream]
+    return shares
+
+
+class BandwidthScheduler:
+    """
+    Shares a server's uplink fairly across all of its concurrent streams.
+
+    Sharing is work-conserving: every REBALANCE_INTERVAL the scheduler looks at
+    what each stream actually sent. A stream whose client drains slower than
+    its share only keeps what it used (plus headroom to grow), and the rest is
+    handed to the streams that are being held back by pacing.
+    """
+
+    def __init__(self, uplink_bitrate=None):
+        # Total uplink in bits per second (None = unlimited)
+        self.capacity = uplink_bitrate / 8 if uplink_bitrate else None
+        self._streams = set()
+        self._shares = {}
+        self._last_rebalance = time.monotonic()
+
+    @property
+    def active_streams(self):
+        return len(self._streams)
+
+    def register(self, pacer):
+        self._streams.add(pacer)
+        self.rebalance()
+
+    def unregister(self, pacer):
+        if pacer in self._streams:
+            self._streams.remove(pacer)
+            self.rebalance()
+
+    def share_for(self, pacer):
+        """Current fair share (bytes/s) for a stream, or None if unlimited."""
+        return self._shares.get(pacer)
+
+    def maybe_rebalance(self):
+        """Re-measure demand if the last rebalance is older than REBALANCE_INTERVAL."""
+        if time.monotonic() - self._last_rebalance >= REBALANCE_INTERVAL:
+            self.rebalance()
+
+    def rebalance(self):
+        """Recompute every stream's share after membership or demand changes."""
+        now = time.monotonic()
+        self._last_rebalance = now
+        demands = {pacer: pacer.measure_demand(now, self._shares.get(pacer)) for pacer in self._streams}
+        if self.capacity is None:
+            self._shares = {}
+            return
+        self._shares = max_min_shares(self.capacity, demands)
+
+
+class StreamPacer:
+    """
+    Token-bucket pacer for a single stream.
+
+    A new stream may send its first few seconds of video at full speed, after
+    which it is held to its sustained rate (video bitrate plus headroom) and to
+    its fair share of the server uplink, whichever is lower.
+    """
+
+    def __init__(self, scheduler, bitrate=None,
+                 burst_seconds=STARTUP_BURST_SECONDS, headroom=PACING_HEADROOM):
+        self.scheduler = scheduler
+        self.sustained_rate = bitrate * headroom / 8 if bitrate else None
+        self.burst_remaining = bitrate * burst_seconds / 8 if bitrate else 0
+        self._next_send = time.monotonic()
+        # What the stream sent since the last rebalance (measured from its first chunk)
+        self._window_start = None
+        self._window_bytes = 0
+
+    @property
+    def in_burst(self):
+        return self.burst_remaining > 0
+
+    def measure_demand(self, now, share):
+        """
+        Report the rate (bytes/s) this stream can use, then start a new window.
+
+        A stream that used most of its `share` wants as much as its cap allows
+        (None = unbounded). One that used less is limited by its client, so it
+        only asks for what it sent plus DEMAND_HEADROOM.
+        """
+        cap = None if self.in_burst else self.sustained_rate
+        demand = cap
+        if self._window_start is not None:
+            if share is not None and now > self._window_start:
+                sent_rate = self._window_bytes / (now - self._window_start)
+                if sent_rate < share * CLIENT_LIMITED_RATIO:
+                    used = max(sent_rate * DEMAND_HEADROOM, MIN_STREAM_RATE)
+                    demand = used if cap is None else min(cap, used)
+            # The window and its byte count always restart together
+            self._window_start = now
+            self._window_bytes = 0
+        return demand
+
+    def current_rate(self):
+        """Effective send rate in bytes per second (None = unpaced)."""
+        rates = [self.scheduler.share_for(self)]
+        if not self.in_burst:
+            rates.append(self.sustained_rate)
+        rates = [rate for rate in rates if rate is not None]
+        return min(rates) if rates else None
+
+    async def throttle(self, nbytes):
+        """Wait until `nbytes` may be sent without exceeding the current rate."""
+        was_bursting = self.in_burst
+        self.burst_remaining = max(0, self.burst_remaining - nbytes)
+        if self._window_start is None:
+            self._window_start = time.monotonic()
+        self._window_bytes += nbytes
+        if was_bursting and not self.in_burst:
+            # Burst exhausted, let the scheduler redistribute our share
+            self.scheduler.rebalance()
+        else:
+            self.scheduler.maybe_rebalance()
+
+        rate = self.current_rate()
+        now = time.monotonic()
+        if rate is None:
+            self._next_send = now
+            return
+
+        # Don't let an idle stream bank credit and burst again later
+        self._next_send = max(self._next_send, now)
+        delay = self._next_send - now
+        self._next_send += nbytes / rate
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def pace(chunks, scheduler, bitrate=None):
+    """
+    Relay `chunks` (an async iterable) to the client with pacing applied.
+
+    The next chunk is only pulled from the source once the previous one has
+    been handed to the client, so upstream reads follow the downstream drain.
+    """
+    pacer = StreamPacer(scheduler, bitrate)
+    scheduler.register(pacer)
+    try:
+        async for chunk in chunks:
+            await pacer.throttle(len(chunk))
+            yield chunk
+    finally:
+        scheduler.unregister(pacer)
+
+
+async def read_file_chunks(path, chunk_size=CHUNK_SIZE, offset=0):
+    """Asynchronously read a file in chunks without blocking the event loop."""
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while chunk := await asyncio.to_thread(f.read, chunk_size):
+            yield chunk
+
+
+async def iter_bytes(data, chunk_size=CHUNK_SIZE):
+    """Split an in-memory body into chunks so it can be paced like a stream."""
+    for start in range(0, len(data), chunk_size):
+        yield data[start:start + chunk_size]
+
+
+# ------------------------- Bitrate Detection -------------------------
+def _iter_boxes(f, start, end):
+    """Yield (type, payload offset, box end) for the MP4 boxes in [start, end)."""
+    offset = start
+    while offset + 8 <= end:
+        f.seek(offset)
+        size, box_type = struct.unpack('>I4s', f.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            return
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def probe_bitrate(path):
+    """Return the average bitrate (bits/s) of an MP4 file, or None if unknown."""
+    try:
+        file_size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            for box_type, payload, box_end in _iter_boxes(f, 0, file_size):
+                if box_type != b'moov':
+                    continue
+                for child, child_payload, _ in _iter_boxes(f, payload, box_end):
+                    if child != b'mvhd':
+                        continue
+                    f.seek(child_payload)
+                    version = f.read(1)[0]
+                    if version == 1:
+                        f.seek(child_payload + 20)
+                        timescale, duration = struct.unpack('>IQ', f.read(12))
+                    else:
+                        f.seek(child_payload + 12)
+                        timescale, duration = struct.unpack('>II', f.read(8))
+                    if not timescale or not duration:
+                        return None
+                    return int(file_size * 8 / (duration / timescale))
+    except (OSError, struct.error, IndexError) as e:
+        print(f"Error probing bitrate of {path}: {e}")
+    return None
+
+
+def parse_bitrate(headers):
+    """Read the bitrate advertised by an upstream server, if any."""
+    try:
+        return int(headers.get(BITRATE_HEADER, '')) or None
+    except ValueError:
+        return None
@@ -0,0 +1,175 @@
+import asyncio
+import os
+
+import pytest
+
+from catalog_sync import (
+    ENTRY_HEADER, NAME_LENGTH, SyncError, build_inventory, file_version, iter_archive, partial_name, plan_transfer,
+    receive_archive, validate_inventory
+)
+
+
+def write_video(directory, name, data, mtime_ns=None):
+    path = directory / name
+    path.write_bytes(data)
+    if mtime_ns is not None:
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return path
+
+
+def version_of(path):
+    stat = os.stat(path)
+    return file_version(stat.st_size, stat.st_mtime_ns)
+
+
+async def archive_bytes(directory, inventory):
+    plan = plan_transfer(directory, inventory)
+    return b''.join([chunk async for chunk in iter_archive(directory, plan)])
+
+
+def entry(name, data, mtime_ns=1, offset=0, size=None):
+    encoded = name.encode()
+    size = len(data) + offset if size is None else size
+    return NAME_LENGTH.pack(len(encoded)) + encoded + ENTRY_HEADER.pack(size, mtime_ns, offset) + data
+
+
+def receive(data, directory):
+    """Feed an archive to receive_archive through an in-memory stream reader."""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        progress = {'files': 0, 'bytes': 0}
+        await receive_archive(reader, directory, progress)
+        return progress
+    return asyncio.run(run())
+
+
+def sync(source, replica):
+    """Send everything `replica` is missing from `source`, in memory."""
+    data = asyncio.run(archive_bytes(source, build_inventory(replica)))
+    return receive(data, replica)
+
+
+@pytest.fixture
+def source(tmp_path):
+    directory = tmp_path / 'source'
+    directory.mkdir()
+    write_video(directory, 'a.mp4', b'A' * 200_000, mtime_ns=1_000_000_000)
+    write_video(directory, 'b.MP4', b'B' * 1000, mtime_ns=2_000_000_000)
+    write_video(directory, 'notes.txt', b'not a video')
+    return directory
+
+
+@pytest.fixture
+def replica(tmp_path):
+    directory = tmp_path / 'replica'
+    directory.mkdir()
+    return directory
+
+
+def test_round_trip_copies_every_video_with_its_version(source, replica):
+    progress = sync(source, replica)
+
+    assert progress == {'files': 2, 'bytes': 201_000}
+    assert sorted(os.listdir(replica)) == ['a.mp4', 'b.MP4']
+    assert (replica / 'a.mp4').read_bytes() == (source / 'a.mp4').read_bytes()
+    assert build_inventory(replica)['files'] == build_inventory(source)['files']
+    # Nothing left to send once the replica is warm
+    assert plan_transfer(source, build_inventory(replica)) == []
+
+
+def test_resume_only_sends_the_rest(source, replica):
+    version = version_of(source / 'a.mp4')
+    (replica / partial_name('a.mp4', version)).write_bytes(b'A' * 50_000)
+
+    plan = plan_transfer(source, build_inventory(replica))
+    assert ('a.mp4', 200_000, 1_000_000_000, 50_000) in plan
+
+    progress = sync(source, replica)
+    assert progress['bytes'] == 150_000 + 1000
+    assert (replica / 'a.mp4').read_bytes() == b'A' * 200_000
+    assert sorted(os.listdir(replica)) == ['a.mp4', 'b.MP4']
+
+
+def test_partial_of_another_version_is_sent_again(source, replica):
+    # Left over from an older copy of a.mp4 (for example from another source)
+    old_version = file_version(400, 5)
+    (replica / partial_name('a.mp4', old_version)).write_bytes(b'O' * 400)
+
+    plan = plan_transfer(source, build_inventory(replica))
+    assert ('a.mp4', 200_000, 1_000_000_000, 0) in plan
+
+    sync(source, replica)
+    assert (replica / 'a.mp4').read_bytes() == b'A' * 200_000
+    assert sorted(os.listdir(replica)) == ['a.mp4', 'b.MP4']
+
+
+def test_resume_entry_never_splices_onto_another_version(replica):
+    (replica / partial_name('a.mp4', file_version(1000, 5))).write_bytes(b'O' * 400)
+
+    # The source claims a resume at 400 of a different copy of a.mp4
+    with pytest.raises(SyncError):
+        receive(entry('a.mp4', b'N' * 600, mtime_ns=9, offset=400) + NAME_LENGTH.pack(0), replica)
+    assert not (replica / 'a.mp4').exists()
+
+
+def test_complete_copy_with_other_content_is_replaced(source, replica):
+    write_video(replica, 'a.mp4', b'X' * 200_000, mtime_ns=7_000_000_000)
+    write_video(replica, 'b.MP4', b'B' * 1000, mtime_ns=2_000_000_000)
+
+    plan = plan_transfer(source, build_inventory(replica))
+    assert [name for name, *_ in plan] == ['a.mp4']
+
+    sync(source, replica)
+    assert (replica / 'a.mp4').read_bytes() == b'A' * 200_000
+
+
+@pytest.mark.parametrize('inventory', [
+    None,
+    [],
+    {'files': []},
+    {'partial': []},
+    {'files': {'a.mp4': 1000}},
+    {'files': {'a.mp4': 'not-a-version'}},
+    {'partial': {'a.mp4': 400}},
+    {'partial': {'a.mp4': {'version': '3e8-5', 'offset': -1}}},
+    {'partial': {'a.mp4': {'version': '3e8-5', 'offset': True}}},
+    {'partial': {'a.mp4': {'version': '3e8-5', 'offset': '400'}}},
+    {'partial': {'a.mp4': {'offset': 400}}},
+])
+def test_malformed_inventory_is_rejected(inventory):
+    with pytest.raises(SyncError):
+        validate_inventory(inventory)
+
+
+def test_valid_inventory_is_accepted(source):
+    validate_inventory({})
+    validate_inventory(build_inventory(source))
+    validate_inventory({'files': {'a.mp4': '3e8-5'}, 'partial': {'b.mp4': {'version': '3e8-5', 'offset': 0}}})
+
+
+@pytest.mark.parametrize('name', ['../escape.mp4', 'nested/video.mp4', '/tmp/absolute.mp4'])
+def test_entry_name_with_a_path_is_rejected(tmp_path, replica, name):
+    with pytest.raises(SyncError):
+        receive(entry(name, b'data') + NAME_LENGTH.pack(0), replica)
+    assert os.listdir(replica) == []
+    assert not (tmp_path / 'escape.mp4').exists()
+
+
+def test_truncated_stream_leaves_a_partial_file(source, replica):
+    data = asyncio.run(archive_bytes(source, build_inventory(replica)))
+    cut = len(data) // 2
+
+    with pytest.raises(asyncio.IncompleteReadError):
+        receive(data[:cut], replica)
+
+    inventory = build_inventory(replica)
+    assert inventory['files'] == {}
+    assert inventory['partial']['a.mp4']['version'] == version_of(source / 'a.mp4')
+    assert 0 < inventory['partial']['a.mp4']['offset'] < 200_000
+
+    # And the next sync picks up where it stopped
+    progress = sync(source, replica)
+    assert progress['bytes'] == 201_000 - inventory['partial']['a.mp4']['offset']
+    assert build_inventory(replica)['files'] == build_inventory(source)['files']
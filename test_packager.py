@@ -0,0 +1,102 @@
+import os
+import struct
+
+import pytest
+
+from packager import (
+    INIT_SEGMENT_NAME, PLAYLIST_NAME, SEGMENT_NAME_FORMAT, ensure_packaged, find_box, iter_boxes, package_video,
+    parse_movie, source_version
+)
+
+SOURCE_VIDEO = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'videos', 'video1.mp4')
+
+
+def read_segment_samples(data):
+    """Parse a moof + mdat media segment into {track id: [(decode time, duration, cts offset, bytes)]}."""
+    moof = find_box(data, [b'moof'])
+    moof_start = moof[0] - 8
+    samples = {}
+    for box_type, _, traf, traf_end in iter_boxes(data, *moof):
+        if box_type != b'traf':
+            continue
+        tfhd = find_box(data, [b'tfhd'], traf, traf_end)
+        tfdt = find_box(data, [b'tfdt'], traf, traf_end)
+        trun = find_box(data, [b'trun'], traf, traf_end)
+        track_id = struct.unpack_from('>I', data, tfhd[0] + 4)[0]
+        assert data[tfdt[0]] == 1
+        decode_time = struct.unpack_from('>Q', data, tfdt[0] + 4)[0]
+        count, data_offset = struct.unpack_from('>Ii', data, trun[0] + 4)
+        offset = moof_start + data_offset
+        for i in range(count):
+            duration, size, _, cts_offset = struct.unpack_from('>IIIi', data, trun[0] + 12 + i * 16)
+            samples.setdefault(track_id, []).append((decode_time, duration, cts_offset, data[offset:offset + size]))
+            decode_time += duration
+            offset += size
+    return samples
+
+
+@pytest.fixture(scope='module')
+def source_tracks():
+    with open(SOURCE_VIDEO, 'rb') as f:
+        _, tracks = parse_movie(f)
+        expected = {}
+        for track in tracks:
+            expected[track.track_id] = []
+            for i in range(len(track.sizes)):
+                f.seek(track.offsets[i])
+                expected[track.track_id].append(
+                    (track.decode_times[i], track.durations[i], track.cts_offsets[i], f.read(track.sizes[i]))
+                )
+    return expected
+
+
+def test_segments_carry_every_source_sample(tmp_path, source_tracks):
+    output_dir = tmp_path / 'video1'
+    # The sample video only has keyframes at 0s and 3s, so cut short segments to split it
+    segment_count = package_video(SOURCE_VIDEO, str(output_dir), segment_duration=2)
+    assert segment_count == 2
+
+    init = (output_dir / INIT_SEGMENT_NAME).read_bytes()
+    trexs = find_box(init, [b'moov', b'mvex'])
+    trex_ids = [struct.unpack_from('>I', init, payload + 4)[0] for _, _, payload, _ in iter_boxes(init, *trexs)]
+    assert sorted(trex_ids) == sorted(source_tracks)
+
+    packaged = {}
+    for n in range(segment_count):
+        segment = (output_dir / SEGMENT_NAME_FORMAT.format(n)).read_bytes()
+        for track_id, samples in read_segment_samples(segment).items():
+            packaged.setdefault(track_id, []).extend(samples)
+
+    assert packaged.keys() == source_tracks.keys()
+    for track_id, expected in source_tracks.items():
+        assert len(packaged[track_id]) == len(expected)
+        for i, (got, want) in enumerate(zip(packaged[track_id], expected)):
+            assert got == want, f"track {track_id} sample {i} differs"
+
+
+def test_playlist_lists_every_segment(tmp_path):
+    output_dir = tmp_path / 'video1'
+    segment_count = package_video(SOURCE_VIDEO, str(output_dir), uri_prefix='v1/')
+    playlist = (output_dir / PLAYLIST_NAME).read_text().splitlines()
+
+    assert playlist[0] == '#EXTM3U'
+    assert playlist[-1] == '#EXT-X-ENDLIST'
+    assert f'#EXT-X-MAP:URI="v1/{INIT_SEGMENT_NAME}"' in playlist
+    uris = [line for line in playlist if not line.startswith('#')]
+    assert uris == ['v1/' + SEGMENT_NAME_FORMAT.format(n) for n in range(segment_count)]
+
+
+def test_changed_source_gets_a_new_version(tmp_path):
+    source = tmp_path / 'video1.mp4'
+    source.write_bytes(open(SOURCE_VIDEO, 'rb').read())
+    video_dir = tmp_path / 'packaged'
+
+    first = ensure_packaged(str(source), str(video_dir))
+    assert first == source_version(str(source))
+    assert ensure_packaged(str(source), str(video_dir)) == first
+
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    second = ensure_packaged(str(source), str(video_dir))
+    assert second != first
+    assert os.listdir(video_dir) == [second]
@@ -0,0 +1,147 @@
+import types
+
+import pytest
+
+import streaming
+from streaming import CHUNK_SIZE, BandwidthScheduler, StreamPacer, max_min_shares
+
+
+class FakeClock:
+    """Stands in for time.monotonic and asyncio.sleep; sleeping is recorded instead of waited for."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.slept += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(streaming, 'time', types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(streaming, 'asyncio', types.SimpleNamespace(sleep=clock.sleep))
+    return clock
+
+
+def run(coroutine):
+    """Run a coroutine that never really suspends (FakeClock.sleep returns at once)."""
+    try:
+        coroutine.send(None)
+    except StopIteration as done:
+        return done.value
+    raise AssertionError("coroutine suspended")
+
+
+def send_chunk(clock, pacer):
+    """Send one chunk and return the time at which the next one may go out."""
+    clock.slept = 0.0
+    run(pacer.throttle(CHUNK_SIZE))
+    return clock.now + clock.slept
+
+
+def simulate(clock, pacers, seconds, client_intervals=None):
+    """
+    Drive several streams on the fake clock and return the chunks each one sent.
+
+    A stream sends its next chunk as soon as its pacer allows it, or, when
+    `client_intervals` gives one, no sooner than its client drains a chunk.
+    """
+    client_intervals = client_intervals or {}
+    ready = {pacer: 0.0 for pacer in pacers}
+    sent = {pacer: 0 for pacer in pacers}
+    while True:
+        pacer = min(ready, key=ready.get)
+        if ready[pacer] >= seconds:
+            return sent
+        clock.now = ready[pacer]
+        ready[pacer] = max(send_chunk(clock, pacer), clock.now + client_intervals.get(pacer, 0))
+        sent[pacer] += 1
+
+
+# ------------------------- max_min_shares -------------------------
+def test_demand_is_capped_and_leftover_goes_to_unbounded_streams():
+    shares = max_min_shares(100, {'small': 10, 'a': None, 'b': None})
+    assert shares == {'small': 10, 'a': 45, 'b': 45}
+
+
+def test_demands_above_an_equal_share_are_split_evenly():
+    shares = max_min_shares(90, {'a': 50, 'b': 60, 'c': None})
+    assert shares == {'a': 30, 'b': 30, 'c': 30}
+
+
+def test_capacity_left_after_every_demand_is_met_is_spread_evenly():
+    shares = max_min_shares(100, {'a': 10, 'b': 30})
+    assert shares == {'a': 40, 'b': 60}
+    assert sum(shares.values()) == 100
+
+
+def test_no_streams_get_no_shares():
+    assert max_min_shares(100, {}) == {}
+
+
+# ------------------------- Pacing -------------------------
+def test_burst_then_sustained_rate(clock):
+    # 10 chunks of video per second: a 10 s burst is 100 chunks, then 15 chunks/s with headroom
+    bitrate = CHUNK_SIZE * 8 * 10
+    pacer = StreamPacer(BandwidthScheduler(), bitrate)
+
+    for _ in range(100):
+        clock.now = send_chunk(clock, pacer)
+    assert clock.now == 0.0
+    assert not pacer.in_burst
+
+    for _ in range(30):
+        clock.now = send_chunk(clock, pacer)
+    assert clock.now == pytest.approx(30 / (10 * streaming.PACING_HEADROOM))
+
+
+def test_unpaced_stream_never_waits(clock):
+    pacer = StreamPacer(BandwidthScheduler())
+    for _ in range(50):
+        assert send_chunk(clock, pacer) == 0.0
+
+
+def test_two_equal_streams_split_the_uplink_evenly(clock):
+    # 20 chunks/s of uplink shared by two streams with no bitrate cap
+    scheduler = BandwidthScheduler(CHUNK_SIZE * 8 * 20)
+    a, b = StreamPacer(scheduler), StreamPacer(scheduler)
+    scheduler.register(a)
+    scheduler.register(b)
+
+    sent = simulate(clock, [a, b], seconds=10)
+    assert sent[a] == pytest.approx(100, abs=2)
+    assert sent[b] == pytest.approx(100, abs=2)
+
+
+def test_share_a_slow_client_leaves_unused_goes_to_the_other_stream(clock):
+    scheduler = BandwidthScheduler(CHUNK_SIZE * 8 * 20)
+    slow, fast = StreamPacer(scheduler), StreamPacer(scheduler)
+    scheduler.register(slow)
+    scheduler.register(fast)
+
+    # The slow client only drains 2 chunks/s, far below its 10 chunks/s equal share
+    sent = simulate(clock, [slow, fast], seconds=10, client_intervals={slow: 0.5})
+    assert sent[slow] == pytest.approx(20, abs=1)
+    # Static equal shares would hold the fast stream to 100 chunks
+    assert sent[fast] > 150
+    assert sent[slow] + sent[fast] <= 200 + 2
+
+
+def test_measure_demand_restarts_the_window_without_a_share(clock):
+    pacer = StreamPacer(BandwidthScheduler())
+    run(pacer.throttle(CHUNK_SIZE))
+
+    clock.now = 1.0
+    pacer.measure_demand(clock.now, None)
+    clock.now = 2.0
+    run(pacer.throttle(CHUNK_SIZE))
+
+    # Only the chunk sent since the last measurement counts, over the second since then
+    used = CHUNK_SIZE / 1.0
+    assert pacer.measure_demand(2.0, share=used * 100) == max(used * streaming.DEMAND_HEADROOM,
+                                                              streaming.MIN_STREAM_RATE)